@@ -13,24 +13,50 @@ Usage:
   image_bytes = await image_storage.fetch(result.hash)
 """
 
+import asyncio
+import base64
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import aiofiles
 import aiofiles.os
 from pathlib import Path
-from typing import Optional, Dict, Any, Union
+from typing import Optional, Dict, Any, Union, AsyncIterable, Callable, TypeVar
 from dataclasses import dataclass
 from datetime import datetime
 import logging
 import io
 import os
+import sys
+import uuid
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# hashlib.sha256 is OpenSSL's EVP implementation when Python is linked against
+# OpenSSL (the normal case), and OpenSSL dispatches to SHA-NI / AVX2 at runtime.
+# Bind it once so the hot path skips the module attribute lookup.
+_sha256 = hashlib.sha256
+SHA256_BACKEND = "openssl" if _sha256.__name__.startswith("openssl_") else "builtin"
+
+DEFAULT_EXTENSION = ".jpg"
+
+# Temp files for in-progress writes live directly under base_path (same
+# filesystem as the final link). Ones older than this are crash leftovers.
+INCOMING_PREFIX = ".incoming-"
+STALE_INCOMING_SECONDS = 3600
+
+# store_stream() buffers request body chunks up to this size per executor hop
+STREAM_FLUSH_BYTES = 256 * 1024
+
+# Cap on cached shard dirs; b32 names fan out to 1024**2 dirs at the default depth
+KNOWN_DIRS_MAX = 65536
+
 
 @dataclass
 class StorageResult:
     """Result of storing an image"""
-    hash: str           # SHA256 hex digest (64 chars)
+    hash: str           # SHA256 digest: hex (64 chars) or base32 (52 chars)
     path: str           # Filesystem path
     size: int           # Size in bytes
     is_duplicate: bool  # True if already existed (dedup)
@@ -53,6 +79,11 @@ class ImageStorage:
         base_path: Optional[str] = None,
         shard_depth: int = 2,
         shard_width: int = 2,
+        hash_encoding: Optional[str] = None,
+        drop_cache_after_write: bool = False,
+        io_workers: Optional[int] = None,
+        recompress_quality: Optional[int] = None,
+        verify_on_fetch: bool = False,
     ):
         # Default to env var or /mnt/raid1/sai-images
         self.base_path = Path(
@@ -62,32 +93,263 @@ class ImageStorage:
         self.shard_depth = shard_depth
         self.shard_width = shard_width
 
+        # "hex" (64 chars) or "b32" (lowercase, unpadded, 52 chars). b32 shortens
+        # filenames and every stored reference; hex paths stay readable via fetch().
+        self.hash_encoding = (
+            hash_encoding or
+            os.environ.get('SAI_IMAGE_HASH_ENCODING', 'hex')
+        )
+        if self.hash_encoding not in ("hex", "b32"):
+            raise ValueError(f"Unsupported hash encoding: {self.hash_encoding}")
+        # Path helpers run on every request; build plain strings instead of Path objects
+        self._base_str = str(self.base_path)
+        self._base_prefix = os.path.join(self._base_str, "")
+        self._default_layout = (shard_depth, shard_width) == (2, 2)
+
+        # Opt-in: drop written pages so archived images don't evict model
+        # weights from the page cache. Leave off when the caller reads the
+        # stored file straight back (e.g. inference on store_stream()'s path).
+        self.drop_cache_after_write = (
+            drop_cache_after_write and hasattr(os, 'posix_fadvise')
+        )
+
+        # Re-encode JPEGs passed to store() at this quality (e.g. 80) before
+        # hashing. Re-encoding strips EXIF and all other metadata (capture
+        # time, camera info); EXIF orientation is baked into the pixels first.
+        # None stores bytes verbatim, as forensic review and regulated
+        # deployments need. Streamed uploads are always stored verbatim.
+        self.recompress_quality = recompress_quality
+
+        # Files are linked into place only once fully written, so a mismatch
+        # means on-disk corruption. When set, fetch() re-hashes what it reads
+        # and returns None on mismatch, leaving the file in place for
+        # inspection.
+        self.verify_on_fetch = verify_on_fetch
+
+        # Shard dirs already created by this process, so makedirs() is only
+        # issued on first touch. Reset once it reaches KNOWN_DIRS_MAX entries.
+        self._known_dirs: set = set()
+
+        # Blocking file work (hash, mkdir, open/write/fsync) runs here. None uses
+        # the event loop's default executor; a dedicated pool keeps high-ingest
+        # stores from queueing behind unrelated to_thread() work.
+        self._io_executor: Optional[ThreadPoolExecutor] = (
+            ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="sai-storage")
+            if io_workers else None
+        )
+
         # Ensure base directory exists
         self.base_path.mkdir(parents=True, exist_ok=True)
-        logger.info(f"Image storage initialized: {self.base_path}")
-
-    def _compute_hash(self, data: bytes) -> str:
+        self._sweep_incoming()
+        logger.info(f"Image storage initialized: {self.base_path} (sha256: {SHA256_BACKEND})")
+        if SHA256_BACKEND != "openssl":
+            logger.warning("hashlib is not OpenSSL-backed; SHA256 will not use SHA-NI")
+
+    def close(self) -> None:
+        """Shut down the dedicated I/O executor, waiting for queued work"""
+        # Later calls fall back to the loop's default executor
+        executor, self._io_executor = self._io_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    async def aclose(self) -> None:
+        """close() without blocking the event loop (for lifespan shutdown)"""
+        await asyncio.to_thread(self.close)
+
+    def _sweep_incoming(self) -> None:
+        """Remove temp files left behind by writes interrupted by a crash"""
+        # Age check: other workers sharing base_path may be mid-write right now
+        cutoff = datetime.now().timestamp() - STALE_INCOMING_SECONDS
+        removed = 0
+        with os.scandir(self._base_str) as entries:
+            for entry in entries:
+                if not entry.name.startswith(INCOMING_PREFIX):
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        if removed:
+            logger.warning(f"Removed {removed} stale temp files from {self._base_str}")
+
+    def _new_temp_path(self) -> str:
+        """Unique temp path under base_path, so the final link stays on one filesystem"""
+        return f"{self._base_prefix}{INCOMING_PREFIX}{uuid.uuid4().hex}.tmp"
+
+    def _compute_hash(self, data: Union[bytes, memoryview]) -> str:
         """Compute SHA256 hash of image data"""
-        return hashlib.sha256(data).hexdigest()
+        # Copying a pre-initialized sha256() instead of constructing one only
+        # wins below ~1 KB (~50 ns) and is slower from 4 KB up, so it isn't
+        # worth it for images.
+        return self._encode_digest(_sha256(data))
+
+    def _encode_digest(self, hasher: "hashlib._Hash") -> str:
+        """Render a finished SHA256 object in the configured hash encoding"""
+        if self.hash_encoding == "b32":
+            return base64.b32encode(hasher.digest()).rstrip(b"=").decode("ascii").lower()
+        return hasher.hexdigest()
+
+    def _hash_file(self, file_path: str) -> "hashlib._Hash":
+        """SHA256 a stored file without reading it into one bytes object"""
+        with open(file_path, "rb") as f:
+            if sys.version_info >= (3, 11):
+                # C-level read loop into a reused buffer
+                return hashlib.file_digest(f, "sha256")
+            hasher = _sha256()
+            for chunk in iter(lambda: f.read(256 * 1024), b""):
+                hasher.update(chunk)
+            return hasher
+
+    def _matches(self, image_hash: str, hasher: "hashlib._Hash") -> bool:
+        """Check a finished SHA256 object against an image name"""
+        # Hex names are always accepted so legacy files verify under b32
+        return image_hash in (self._encode_digest(hasher), hasher.hexdigest())
+
+    def _legacy_hex(self, image_hash: str) -> Optional[str]:
+        """Hex form of a base32 hash, for images stored before switching to b32"""
+        if self.hash_encoding != "b32" or len(image_hash) != 52:
+            return None
+        try:
+            digest = base64.b32decode(image_hash.upper() + "====")
+        except ValueError:
+            return None
+        return digest.hex()
+
+    def _existing_legacy_path(self, image_hash: str, extension: str) -> Optional[str]:
+        """Path of a pre-b32 hex copy of this image, if one is on disk"""
+        legacy_hash = self._legacy_hex(image_hash)
+        if legacy_hash is None:
+            return None
+        legacy_path = self._get_file_path(legacy_hash, extension)
+        return legacy_path if os.path.exists(legacy_path) else None
 
-    def _get_shard_path(self, image_hash: str) -> Path:
+    def _get_shard_path(self, image_hash: str) -> str:
         """Get sharded directory path for a hash"""
+        if self._default_layout:
+            return f"{self._base_prefix}{image_hash[0:2]}/{image_hash[2:4]}"
         parts = []
         for i in range(self.shard_depth):
             start = i * self.shard_width
             end = start + self.shard_width
             parts.append(image_hash[start:end])
-        return self.base_path.joinpath(*parts)
+        return os.path.join(self._base_str, *parts)
 
-    def _get_file_path(self, image_hash: str, extension: str = ".jpg") -> Path:
+    def _get_file_path(self, image_hash: str, extension: str = DEFAULT_EXTENSION) -> str:
         """Get full file path for a hash"""
-        shard_dir = self._get_shard_path(image_hash)
-        return shard_dir / f"{image_hash}{extension}"
+        if self._default_layout:
+            # Inlined _get_shard_path for the production 2x2 layout
+            return f"{self._base_prefix}{image_hash[0:2]}/{image_hash[2:4]}/{image_hash}{extension}"
+        return f"{self._get_shard_path(image_hash)}/{image_hash}{extension}"
+
+    async def _run_io(self, func: Callable[..., T], *args: Any) -> T:
+        """Run blocking file work on the storage executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io_executor, func, *args)
+
+    def _ensure_shard_dir(self, shard_dir: str) -> None:
+        """Create a shard directory unless this process already has"""
+        if shard_dir not in self._known_dirs:
+            os.makedirs(shard_dir, exist_ok=True)
+            if len(self._known_dirs) >= KNOWN_DIRS_MAX:
+                self._known_dirs.clear()
+            self._known_dirs.add(shard_dir)
+
+    def _in_shard_dir(self, shard_dir: str, func: Callable[..., T], *args: Any) -> T:
+        """
+        Call func to create an entry in shard_dir, creating the dir first.
+
+        If the dir was removed after we cached it (cleanup, rmdir after
+        delete), func fails with FileNotFoundError; recreate it and retry once.
+        """
+        self._ensure_shard_dir(shard_dir)
+        try:
+            return func(*args)
+        except FileNotFoundError:
+            self._known_dirs.discard(shard_dir)
+            self._ensure_shard_dir(shard_dir)
+            return func(*args)
+
+    def _write_new(self, file_path: str, shard_dir: str, data: Union[bytes, memoryview]) -> bool:
+        """
+        Write data to a temp file, then hard-link it to file_path.
+
+        Returns False if file_path already exists (duplicate). The link is
+        atomic and never replaces an existing file, so a partial image never
+        sits under its final name and two concurrent stores of the same image
+        can't both win. The temp name is always removed. The shard dir is
+        created in the same executor hop.
+        """
+        # Cheap stat first so a duplicate not yet in the LRU (e.g. after a
+        # restart) doesn't cost a full write + fsync
+        if os.path.exists(file_path):
+            return False
+        temp_path = self._new_temp_path()
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            try:
+                self._write_all(fd, data)
+                self._sync_fd(fd)
+            finally:
+                os.close(fd)
+            return self._link_new(temp_path, file_path, shard_dir)
+        finally:
+            os.unlink(temp_path)
+
+    def _write_all(self, fd: int, data: Union[bytes, memoryview]) -> None:
+        """Write all of data to fd, looping over short writes"""
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+    def _sync_fd(self, fd: int) -> None:
+        """fsync a finished file and optionally drop it from the page cache"""
+        os.fsync(fd)
+        if self.drop_cache_after_write:
+            # Pages are clean after fsync, so DONTNEED can release them
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def _recompress(self, data: Union[bytes, memoryview]) -> Union[bytes, memoryview]:
+        """
+        Re-encode a JPEG at recompress_quality, keeping the original if not smaller.
+
+        imencode writes no EXIF, so all metadata is lost. IMREAD_COLOR applies
+        the EXIF orientation while decoding, so the image still displays the
+        right way up once the Orientation tag is gone.
+        """
+        import cv2
+        import numpy as np
+
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            logger.warning("Recompress skipped: image could not be decoded")
+            return data
+        ok, buffer = cv2.imencode(
+            '.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.recompress_quality]
+        )
+        if not ok or buffer.nbytes >= len(data):
+            return data
+        return buffer.tobytes()
+
+    def _absorb_chunk(self, hasher: "hashlib._Hash", fd: int, chunk: Union[bytes, bytearray]) -> None:
+        """Hash and write one chunk of a streamed image"""
+        hasher.update(chunk)
+        self._write_all(fd, chunk)
+
+    def _link_new(self, temp_path: str, file_path: str, shard_dir: str) -> bool:
+        """Hard-link a finished temp file to file_path. False if it already exists."""
+        try:
+            self._in_shard_dir(shard_dir, os.link, temp_path, file_path)
+        except FileExistsError:
+            return False
+        return True
 
     async def store(
         self,
         image_data: Union[bytes, io.BytesIO],
-        extension: str = ".jpg",
+        extension: str = DEFAULT_EXTENSION,
     ) -> StorageResult:
         """
         Store image with content-based addressing.
@@ -100,68 +362,174 @@ class ImageStorage:
             StorageResult with hash, path, size, dedup status
         """
         if isinstance(image_data, io.BytesIO):
-            image_data = image_data.getvalue()
+            # Zero-copy view of the buffer; getvalue() would duplicate it
+            image_data = image_data.getbuffer()
+
+        if self.recompress_quality is not None and extension in (".jpg", ".jpeg"):
+            # Hash the re-encoded bytes so the address matches what is on disk
+            image_data = await self._run_io(self._recompress, image_data)
 
-        image_hash = self._compute_hash(image_data)
+        # OpenSSL releases the GIL while hashing, so this keeps the event loop free
+        image_hash = await self._run_io(self._compute_hash, image_data)
         file_path = self._get_file_path(image_hash, extension)
 
-        is_duplicate = file_path.exists()
+        # Under b32, an image stored before the switch still counts as a duplicate
+        legacy_path = None
+        if self.hash_encoding == "b32":
+            legacy_path = await self._run_io(self._existing_legacy_path, image_hash, extension)
 
-        if not is_duplicate:
+        if legacy_path is not None:
+            file_path = legacy_path
+            is_duplicate = True
+        else:
+            # Always check the filesystem: other workers (or cleanup) may have
+            # removed the file, so no in-process cache can answer this safely
             shard_dir = self._get_shard_path(image_hash)
-            await aiofiles.os.makedirs(shard_dir, exist_ok=True)
-
-            # Atomic write: temp file then rename
-            temp_path = file_path.with_suffix('.tmp')
             try:
-                async with aiofiles.open(temp_path, 'wb') as f:
-                    await f.write(image_data)
-                await aiofiles.os.rename(temp_path, file_path)
-                logger.info(f"Stored: {image_hash[:16]}... ({len(image_data):,} bytes)")
+                created = await self._run_io(self._write_new, file_path, shard_dir, image_data)
             except Exception as e:
-                if temp_path.exists():
-                    await aiofiles.os.remove(temp_path)
                 logger.error(f"Storage failed: {e}")
                 raise
-        else:
+            is_duplicate = not created
+
+        if is_duplicate:
             logger.debug(f"Deduplicated: {image_hash[:16]}...")
+        else:
+            logger.info(f"Stored: {image_hash[:16]}... ({len(image_data):,} bytes)")
 
         return StorageResult(
             hash=image_hash,
-            path=str(file_path),
+            path=file_path,
             size=len(image_data),
             is_duplicate=is_duplicate,
             stored_at=datetime.utcnow()
         )
 
-    async def fetch(self, image_hash: str, extension: str = ".jpg") -> Optional[bytes]:
+    async def store_stream(
+        self,
+        chunks: AsyncIterable[bytes],
+        extension: str = DEFAULT_EXTENSION,
+    ) -> StorageResult:
+        """
+        Store image from an async byte stream (e.g. FastAPI request.stream()).
+
+        Each chunk is hashed and written to a temp file as it arrives, so the
+        image never exists as a single bytes object. Once the hash is known the
+        temp file is hard-linked to its content address; an existing link
+        means the image is a duplicate.
+
+        Args:
+            chunks: Async iterable of raw image bytes
+            extension: File extension (default .jpg)
+
+        Returns:
+            StorageResult with hash, path, size, dedup status
+        """
+        hasher = _sha256()
+        size = 0
+        temp_path = self._new_temp_path()
+        fd = await self._run_io(os.open, temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            try:
+                # Request bodies arrive in small chunks; coalesce them so each
+                # executor hop hashes and writes a worthwhile amount
+                pending = bytearray()
+                async for chunk in chunks:
+                    pending += chunk
+                    if len(pending) >= STREAM_FLUSH_BYTES:
+                        await self._run_io(self._absorb_chunk, hasher, fd, pending)
+                        size += len(pending)
+                        pending = bytearray()
+                if pending:
+                    await self._run_io(self._absorb_chunk, hasher, fd, pending)
+                    size += len(pending)
+                await self._run_io(self._sync_fd, fd)
+            finally:
+                await self._run_io(os.close, fd)
+
+            image_hash = self._encode_digest(hasher)
+            file_path = self._get_file_path(image_hash, extension)
+            legacy_path = None
+            if self.hash_encoding == "b32":
+                legacy_path = await self._run_io(
+                    self._existing_legacy_path, image_hash, extension
+                )
+
+            if legacy_path is not None:
+                file_path = legacy_path
+                is_duplicate = True
+            else:
+                shard_dir = self._get_shard_path(image_hash)
+                try:
+                    is_duplicate = not await self._run_io(
+                        self._link_new, temp_path, file_path, shard_dir
+                    )
+                except Exception as e:
+                    logger.error(f"Storage failed: {e}")
+                    raise
+        finally:
+            await self._run_io(os.unlink, temp_path)
+
+        if is_duplicate:
+            logger.debug(f"Deduplicated: {image_hash[:16]}...")
+        else:
+            logger.info(f"Stored: {image_hash[:16]}... ({size:,} bytes, streamed)")
+
+        return StorageResult(
+            hash=image_hash,
+            path=file_path,
+            size=size,
+            is_duplicate=is_duplicate,
+            stored_at=datetime.utcnow()
+        )
+
+    async def fetch(self, image_hash: str, extension: str = DEFAULT_EXTENSION) -> Optional[bytes]:
         """Fetch image bytes by hash"""
         file_path = self._get_file_path(image_hash, extension)
 
-        if not file_path.exists():
+        if not os.path.exists(file_path):
+            legacy_hash = self._legacy_hex(image_hash)
+            if legacy_hash is not None:
+                return await self.fetch(legacy_hash, extension)
             logger.warning(f"Not found: {image_hash[:16]}...")
             return None
 
         async with aiofiles.open(file_path, 'rb') as f:
-            return await f.read()
+            data = await f.read()
 
-    def exists(self, image_hash: str, extension: str = ".jpg") -> bool:
-        """Check if image exists by hash"""
-        return self._get_file_path(image_hash, extension).exists()
+        if self.verify_on_fetch:
+            hasher = await self._run_io(_sha256, data)
+            if not self._matches(image_hash, hasher):
+                logger.error(f"Corrupt image, not served: {image_hash[:16]}...")
+                return None
+
+        return data
 
-    def get_path(self, image_hash: str, extension: str = ".jpg") -> str:
+    def exists(self, image_hash: str, extension: str = DEFAULT_EXTENSION) -> bool:
+        """Check if image exists by hash"""
+        file_path = self._get_file_path(image_hash, extension)
+        if os.path.exists(file_path):
+            return True
+        legacy_hash = self._legacy_hex(image_hash)
+        if legacy_hash is not None:
+            return self.exists(legacy_hash, extension)
+        return False
+
+    def get_path(self, image_hash: str, extension: str = DEFAULT_EXTENSION) -> str:
         """Get filesystem path for hash (doesn't check existence)"""
-        return str(self._get_file_path(image_hash, extension))
+        return self._get_file_path(image_hash, extension)
 
-    def get_relative_path(self, image_hash: str, extension: str = ".jpg") -> str:
+    def get_relative_path(self, image_hash: str, extension: str = DEFAULT_EXTENSION) -> str:
         """Get path relative to base_path"""
-        file_path = self._get_file_path(image_hash, extension)
-        return str(file_path.relative_to(self.base_path))
+        return self._get_file_path(image_hash, extension)[len(self._base_prefix):]
 
-    async def delete(self, image_hash: str, extension: str = ".jpg") -> bool:
+    async def delete(self, image_hash: str, extension: str = DEFAULT_EXTENSION) -> bool:
         """Delete image by hash. Returns True if deleted."""
         file_path = self._get_file_path(image_hash, extension)
-        if not file_path.exists():
+        if not os.path.exists(file_path):
+            legacy_hash = self._legacy_hex(image_hash)
+            if legacy_hash is not None:
+                return await self.delete(legacy_hash, extension)
             return False
         await aiofiles.os.remove(file_path)
         logger.info(f"Deleted: {image_hash[:16]}...")
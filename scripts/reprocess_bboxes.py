@@ -4,16 +4,19 @@ Re-run YOLO inference on executions with zero bounding boxes.
 Updates ONLY execution_analysis - does NOT touch executions table.
 
 Usage:
-    python3 reprocess_bboxes.py [--dry-run] [--batch-size N] [--limit N]
+    python3 reprocess_bboxes.py [--dry-run] [--batch-size N] [--limit N] [--workers N]
 """
 
 import argparse
-import json
 import os
 import sys
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterator
 import psycopg2
-import requests
+import psycopg2.extras
+import httpx
+import orjson
 from pathlib import Path
 
 # ── Config ────────────────────────────────────────────────────────────────────
@@ -29,27 +32,47 @@ def xyxy_to_xywh(x1, y1, x2, y2):
     return {"x": x1, "y": y1, "width": x2 - x1, "height": y2 - y1}
 
 
-def infer_image(image_path: str) -> dict | None:
+def normalize_scores(confidence_scores: dict) -> dict:
+    """Key confidence scores by plain class name.
+
+    Older inference builds serialize the DetectionClass enum as
+    "DetectionClass.FIRE" instead of "fire".
+    """
+    return {k.rsplit(".", 1)[-1].lower(): v for k, v in confidence_scores.items()}
+
+
+def infer_image(client: httpx.Client, image_path: str) -> dict | None:
     """POST image to YOLO service, return parsed detections or None on error."""
     try:
+        # Pass the open handle, not its bytes: httpx sizes the multipart body
+        # with fstat and streams the file in 64 KiB chunks.
         with open(image_path, "rb") as f:
-            resp = requests.post(
+            resp = client.post(
                 INFERENCE_URL,
                 files={"file": (Path(image_path).name, f, "image/jpeg")},
                 data={
-                    "confidence_threshold": CONFIDENCE_THRESHOLD,
-                    "iou_threshold": IOU_THRESHOLD,
+                    "confidence_threshold": str(CONFIDENCE_THRESHOLD),
+                    "iou_threshold": str(IOU_THRESHOLD),
                     "return_image": "false",
                 },
-                timeout=REQUEST_TIMEOUT,
             )
         resp.raise_for_status()
-        return resp.json()
+        result = resp.json()
+        # Inside the try: a malformed body fails this row, not the whole run
+        result["confidence_scores"] = normalize_scores(result.get("confidence_scores") or {})
+        return result
     except Exception as e:
         print(f"    ERROR calling inference: {e}", file=sys.stderr)
         return None
 
 
+def infer_timed(client: httpx.Client, image_path: str) -> tuple[dict | None, float]:
+    """Run infer_image and return (result, elapsed seconds)."""
+    t1 = time.time()
+    result = infer_image(client, image_path)
+    return result, time.time() - t1
+
+
 def build_detections(raw_detections: list) -> list:
     """Convert YOLO xyxy detections to dashboard xywh format."""
     out = []
@@ -66,36 +89,66 @@ def build_detections(raw_detections: list) -> list:
     return out
 
 
-def update_analysis(cur, execution_id: int, result: dict, dry_run: bool) -> bool:
-    """Update execution_analysis with corrected detection data."""
-    raw_detections = result.get("detections", [])
+# Batched path: one statement per batch, RETURNING the ids actually updated so
+# rows that matched nothing are reported instead of counted as ok.
+BATCH_UPDATE_SQL = """
+    UPDATE execution_analysis AS ea SET
+        detections          = v.detections,
+        detection_count     = v.detection_count,
+        has_fire            = v.has_fire,
+        has_smoke           = v.has_smoke,
+        confidence_fire     = v.confidence_fire,
+        confidence_smoke    = v.confidence_smoke,
+        confidence_score    = v.confidence_score,
+        updated_at          = NOW()
+    FROM (VALUES %s) AS v(detections, detection_count, has_fire, has_smoke,
+                          confidence_fire, confidence_smoke, confidence_score, execution_id)
+    WHERE ea.execution_id = v.execution_id
+    RETURNING ea.execution_id
+"""
+
+BATCH_UPDATE_TEMPLATE = (
+    "(%s::jsonb, %s::integer, %s::boolean, %s::boolean,"
+    " %s::numeric, %s::numeric, %s::numeric, %s::bigint)"
+)
+
+# Row-by-row fallback: prepared once per connection so Postgres parses and
+# plans the UPDATE a single time; each retried row only sends EXECUTE.
+PREPARE_SQL = """
+    PREPARE reprocess_update (jsonb, integer, boolean, boolean, numeric, numeric, numeric, bigint) AS
+    UPDATE execution_analysis SET
+        detections          = $1,
+        detection_count     = $2,
+        has_fire            = $3,
+        has_smoke           = $4,
+        confidence_fire     = $5,
+        confidence_smoke    = $6,
+        confidence_score    = $7,
+        updated_at          = NOW()
+    WHERE execution_id = $8
+"""
+
+UPDATE_SQL = "EXECUTE reprocess_update (%s, %s, %s, %s, %s, %s, %s, %s)"
+
+
+def build_update_params(execution_id: int, result: dict, dry_run: bool) -> tuple | None:
+    """Build UPDATE_SQL parameters from an inference result (None on dry-run)."""
+    raw_detections = result.get("detections") or []
     detections = build_detections(raw_detections)
 
-    confidence_scores = result.get("confidence_scores", {})
-    # confidence_scores keys are enum values: may be "fire"/"smoke" or DetectionClass objects
-    conf_fire  = confidence_scores.get("fire",  confidence_scores.get("DetectionClass.FIRE",  0)) or 0
-    conf_smoke = confidence_scores.get("smoke", confidence_scores.get("DetectionClass.SMOKE", 0)) or 0
+    confidence_scores = result.get("confidence_scores", {})  # normalized by infer_image
+    conf_fire  = confidence_scores.get("fire",  0) or 0
+    conf_smoke = confidence_scores.get("smoke", 0) or 0
     conf_score = max(conf_fire, conf_smoke) or None
 
     if dry_run:
         print(f"    [DRY RUN] would update execution_id={execution_id}: "
               f"{len(detections)} detections, has_fire={result.get('has_fire')}, "
               f"has_smoke={result.get('has_smoke')}, alert_level derived")
-        return True
-
-    cur.execute("""
-        UPDATE execution_analysis SET
-            detections          = %s,
-            detection_count     = %s,
-            has_fire            = %s,
-            has_smoke           = %s,
-            confidence_fire     = %s,
-            confidence_smoke    = %s,
-            confidence_score    = %s,
-            updated_at          = NOW()
-        WHERE execution_id = %s
-    """, (
-        json.dumps(detections),
+        return None
+
+    return (
+        orjson.dumps(detections).decode(),  # psycopg2 wants str for jsonb
         len(detections),
         result.get("has_fire", False),
         result.get("has_smoke", False),
@@ -103,26 +156,91 @@ def update_analysis(cur, execution_id: int, result: dict, dry_run: bool) -> bool
         conf_smoke if conf_smoke > 0 else None,
         conf_score,
         execution_id,
-    ))
-    return cur.rowcount == 1
-
-
-def fetch_targets(cur, limit: int | None) -> list[tuple]:
-    """Fetch executions with zero bounding boxes that have images."""
-    query = """
-        SELECT ea.execution_id, ei.original_path
-        FROM execution_analysis ea
-        JOIN execution_images ei ON ea.execution_id = ei.execution_id
-        WHERE ea.detections IS NOT NULL
-          AND ea.detections != '[]'::jsonb
-          AND (ea.detections->0->'bounding_box'->>'width')::numeric = 0
-          AND ei.original_path IS NOT NULL
-        ORDER BY ea.execution_id
+    )
+
+
+def flush_updates(conn, cur, batch: list[tuple]) -> tuple[int, int]:
+    """Write a batch of updates with a single commit. Returns (ok, fail).
+
+    If the batch fails it is rolled back and retried row by row, so one bad
+    row does not lose the rest of the batch.
     """
+    if not batch:
+        return 0, 0
+
+    try:
+        rows = psycopg2.extras.execute_values(
+            cur, BATCH_UPDATE_SQL, batch,
+            template=BATCH_UPDATE_TEMPLATE, page_size=len(batch), fetch=True,
+        )
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"    batch of {len(batch)} failed, retrying individually: {e}", file=sys.stderr)
+    else:
+        updated = {row[0] for row in rows}
+        ok = 0
+        fail = 0
+        for params in batch:
+            if params[-1] in updated:
+                ok += 1
+            else:
+                print(f"    exec {params[-1]}: UPDATE returned 0 rows — skipping", file=sys.stderr)
+                fail += 1
+        print(f"    committed {ok} updates")
+        return ok, fail
+
+    ok = 0
+    fail = 0
+    for params in batch:
+        exec_id = params[-1]
+        try:
+            cur.execute(UPDATE_SQL, params)
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"    exec {exec_id}: UPDATE failed: {e}", file=sys.stderr)
+            fail += 1
+            continue
+        if cur.rowcount == 1:
+            conn.commit()
+            ok += 1
+        else:
+            conn.rollback()
+            print(f"    exec {exec_id}: UPDATE returned 0 rows — skipping", file=sys.stderr)
+            fail += 1
+    return ok, fail
+
+
+TARGETS_FROM = """
+    FROM execution_analysis ea
+    JOIN execution_images ei ON ea.execution_id = ei.execution_id
+    WHERE ea.detections IS NOT NULL
+      AND ea.detections != '[]'::jsonb
+      AND (ea.detections->0->'bounding_box'->>'width')::numeric = 0
+      AND ei.original_path IS NOT NULL
+"""
+
+
+def count_targets(cur, limit: int | None) -> int:
+    """Count executions with zero bounding boxes that have images."""
+    cur.execute("SELECT COUNT(*)" + TARGETS_FROM)
+    total = cur.fetchone()[0]
+    return min(total, limit) if limit else total
+
+
+def iter_targets(conn, limit: int | None) -> Iterator[tuple]:
+    """Stream executions with zero bounding boxes that have images."""
+    query = "SELECT ea.execution_id, ei.original_path" + TARGETS_FROM + "ORDER BY ea.execution_id"
     if limit:
         query += f" LIMIT {int(limit)}"
-    cur.execute(query)
-    return cur.fetchall()
+    # Server-side cursor: rows arrive itersize at a time instead of all at once.
+    # WITH HOLD keeps it open across the per-batch commits in main(); commit
+    # right away so a rolled-back batch can't take the cursor with it.
+    with conn.cursor(name="reprocess_targets", withhold=True) as scur:
+        scur.itersize = 1000
+        scur.execute(query)
+        conn.commit()
+        yield from scur
 
 
 # ── Main ───────────────────────────────────────────────────────────────────────
@@ -131,15 +249,22 @@ def main():
     parser = argparse.ArgumentParser(description="Re-run YOLO on zero-bbox executions")
     parser.add_argument("--dry-run", action="store_true", help="Query and infer but do not write to DB")
     parser.add_argument("--limit",   type=int, default=None, help="Max executions to process")
-    parser.add_argument("--delay",   type=float, default=0.1, help="Seconds between requests (default 0.1)")
+    parser.add_argument("--batch-size", type=int, default=100, help="Updates per DB commit (default 100)")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent inference requests (default 8)")
     args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
 
     conn = psycopg2.connect(DB_DSN)
     conn.autocommit = False
     cur = conn.cursor()
+    if not args.dry_run:
+        cur.execute(PREPARE_SQL)
+        conn.commit()
 
-    targets = fetch_targets(cur, args.limit)
-    total = len(targets)
+    total = count_targets(cur, args.limit)
     print(f"Found {total} executions to reprocess{' (dry-run)' if args.dry_run else ''}.")
 
     if total == 0:
@@ -149,41 +274,70 @@ def main():
     ok = 0
     skip = 0
     fail = 0
+    done = 0
     t0 = time.time()
 
-    for i, (exec_id, img_path) in enumerate(targets, 1):
-        prefix = f"[{i:>3}/{total}] exec {exec_id}"
-
-        if not Path(img_path).exists():
-            print(f"{prefix}  SKIP  image not found: {img_path}")
-            skip += 1
-            continue
-
-        print(f"{prefix}  inferring {img_path} ...", end=" ", flush=True)
-        t1 = time.time()
-        result = infer_image(img_path)
-        elapsed = time.time() - t1
-
-        if result is None:
-            print(f"FAILED ({elapsed:.1f}s)")
-            fail += 1
-            continue
-
-        n_det = result.get("detection_count", 0)
-        print(f"{n_det} detections  ({elapsed:.1f}s)", end=" ")
-
-        if update_analysis(cur, exec_id, result, args.dry_run):
-            if not args.dry_run:
-                conn.commit()
-            print("✓")
-            ok += 1
-        else:
-            print("UPDATE returned 0 rows — skipping")
-            conn.rollback()
-            fail += 1
-
-        if args.delay > 0 and i < total:
-            time.sleep(args.delay)
+    # Inference runs in worker threads over one pooled keep-alive client; the
+    # pool size bounds load on the inference server. DB writes stay on this thread.
+    limits = httpx.Limits(max_connections=args.workers, max_keepalive_connections=args.workers)
+    batch = []
+    try:
+        with httpx.Client(timeout=REQUEST_TIMEOUT, limits=limits) as client, \
+                ThreadPoolExecutor(max_workers=args.workers) as pool:
+            in_flight = {}
+            targets = iter_targets(conn, args.limit)
+
+            while True:
+                # Keep the pool fed without pulling the whole target list into memory
+                for exec_id, img_path in targets:
+                    if not Path(img_path).exists():
+                        done += 1
+                        print(f"[{done:>3}/{total}] exec {exec_id}  SKIP  image not found: {img_path}")
+                        skip += 1
+                        continue
+                    in_flight[pool.submit(infer_timed, client, img_path)] = (exec_id, img_path)
+                    if len(in_flight) >= args.workers * 2:
+                        break
+
+                if not in_flight:
+                    break
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    exec_id, img_path = in_flight.pop(future)
+                    result, elapsed = future.result()
+                    done += 1
+                    prefix = f"[{done:>3}/{total}] exec {exec_id}"
+
+                    if result is None:
+                        print(f"{prefix}  {img_path}  FAILED ({elapsed:.1f}s)")
+                        fail += 1
+                        continue
+
+                    n_det = result.get("detection_count", 0)
+                    print(f"{prefix}  {img_path}  {n_det} detections  ({elapsed:.1f}s)")
+
+                    try:
+                        params = build_update_params(exec_id, result, args.dry_run)
+                    except Exception as e:
+                        print(f"    exec {exec_id}: bad inference result — {e}", file=sys.stderr)
+                        fail += 1
+                        continue
+                    if params is None:
+                        ok += 1
+                        continue
+
+                    batch.append(params)
+                    if len(batch) >= args.batch_size:
+                        n_ok, n_fail = flush_updates(conn, cur, batch)
+                        ok += n_ok
+                        fail += n_fail
+                        batch.clear()
+    finally:
+        # Runs on abort too, so rows already inferred are not lost
+        n_ok, n_fail = flush_updates(conn, cur, batch)
+        ok += n_ok
+        fail += n_fail
 
     total_time = time.time() - t0
     print(f"\nDone in {total_time:.1f}s — ok={ok}  skip={skip}  fail={fail}")